@@ -1,9 +1,11 @@
-#!/usr/bin/env python
+#!/usr/bin/env pypy3
 
-import os, subprocess, shutil, time, json
+import os, sys, subprocess, shutil, time, json, atexit, signal, heapq
 import logging, logging.handlers
-from pathlib import Path
 from inspect import getsourcefile
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from inotify_simple import INotify, flags
 
 #######################################################################
 # Script: Raspberry Pi USB File Copy and Deletion Service
@@ -23,8 +25,21 @@ from inspect import getsourcefile
 BASE_PATH = os.path.dirname(os.path.abspath(getsourcefile(lambda: 0)))
 DESTINATION_BASE_DIR = os.path.join(BASE_PATH, 'transfer')
 COPYING_ACTIVE_FILE = os.path.join(DESTINATION_BASE_DIR, 'copyingActive')
+COPYING_IDLE_FILE = COPYING_ACTIVE_FILE + '.tmp'  # renamed to COPYING_ACTIVE_FILE while a copy runs
 USB_IMG = '/piusb.bin'
 SOURCE_DIR = '/mnt/usb_share'
+LOOP_DEVICE_CACHE = '/run/piusb.loop'
+EVENT_DEBOUNCE_TIME = 1.0  # the image must be quiet this long before a copy run starts
+
+class Config(NamedTuple):
+    # settings read from config.json; unknown keys are ignored, fields without a default are required
+    CopyCheckCycleTime: float
+    DeleteOnUSBCycleTime: float
+    KeepMaxFilesOnUSB: int
+    CopyParallelism: int = 4
+    # only safe if the host never writes to the image while this service runs: the long-lived mount caches the
+    # FAT and directories, so new host files stay invisible and a deletion run would work from stale metadata
+    KeepUSBMounted: bool = False
 
 def setup_logging(log_file_full_path):
     base_path = os.path.dirname(log_file_full_path)
@@ -34,7 +49,7 @@ def setup_logging(log_file_full_path):
     
     if base_path:
         os.makedirs(base_path, exist_ok=True)
-    log_formatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
+    log_formatter = logging.Formatter("%(asctime)s [%(levelname)-5.5s]  %(message)s")
     root_logger = logging.getLogger()
     root_logger.setLevel(logging.INFO)
     file_handler = logging.handlers.RotatingFileHandler(log_file_full_path, maxBytes=500000, backupCount=7)
@@ -45,66 +60,161 @@ def setup_logging(log_file_full_path):
     root_logger.addHandler(console_handler)
 
 def get_files_since_point_in_time(start_dir, point_in_time, newest_dir_count):
+    # iterative walk with an explicit stack, descending only into the newest directories of each level
     all_files = []
-    directories = []
-    for item in os.scandir(start_dir):
-        if item.is_file() and (max(item.stat().st_mtime, item.stat().st_ctime) > point_in_time):
-            all_files.append(item.path)
-        elif item.is_dir():
-            directories.append(item)
-    
-    directories.sort(key=lambda d: d.stat().st_mtime, reverse=True)
-    for i in range(newest_dir_count):
-        if len(directories) > i:
-            all_files.extend(get_files_since_point_in_time(directories[i], point_in_time, newest_dir_count))
+    pending_dirs = [start_dir]
+    while pending_dirs:
+        directories = []
+        with os.scandir(pending_dirs.pop()) as items:
+            for item in items:
+                st = item.stat()  # one stat per entry, reused for the age check and the directory sort
+                if item.is_file(follow_symlinks=False) and max(st.st_mtime, st.st_ctime) > point_in_time:
+                    all_files.append(item.path)
+                elif item.is_dir(follow_symlinks=False):
+                    directories.append((st.st_mtime, item.path))
+        
+        directories.sort(reverse=True)
+        pending_dirs.extend(path for _, path in directories[:newest_dir_count])
     return all_files
 
 def get_all_file_entries_delete_empty_dirs(start_dir):
+    # returns (mtime, path) tuples so callers can sort by age without statting again
     all_file_entries = []
-    items = os.scandir(start_dir)
-    counter = 0
-    for item in items:
-        counter += 1
-        if item.is_file():
-            all_file_entries.append(item)
-        elif item.is_dir():
-            all_file_entries.extend(get_all_file_entries_delete_empty_dirs(item.path))
-    
-    # Version 2 Change: Log directory deletions.
-    if counter == 0:
-        logging.info(f"Deleting empty directory: {start_dir}")
-        os.rmdir(start_dir)
+    empty_dirs = set()
+    # bottom-up, so every directory is listed before its parent; the parent's dirfd is then used to remove it
+    for dirpath, dirnames, filenames, dirfd in os.fwalk(start_dir, topdown=False):
+        for name in filenames:
+            all_file_entries.append((os.stat(name, dir_fd=dirfd).st_mtime, os.path.join(dirpath, name)))
+        
+        # Version 2 Change: Log directory deletions.
+        for name in dirnames:
+            path = os.path.join(dirpath, name)
+            if path in empty_dirs:
+                empty_dirs.remove(path)
+                logging.info(f"Deleting empty directory: {path}")
+                os.rmdir(name, dir_fd=dirfd)
+        if not dirnames and not filenames and dirpath != start_dir:
+            empty_dirs.add(dirpath)
     
     return all_file_entries
 
+def delete_files(paths):
+    # unlink relative to one open fd per directory instead of resolving every full path again
+    deleted = 0
+    paths_by_dir = {}
+    for path in paths:
+        paths_by_dir.setdefault(os.path.dirname(path), []).append(path)
+    for directory, dir_paths in paths_by_dir.items():
+        try:
+            dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        except OSError as e:
+            logging.error(f"Failed to open directory {directory} for deletion: {e}")
+            continue
+        try:
+            for path in dir_paths:
+                try:
+                    os.unlink(os.path.basename(path), dir_fd=dir_fd)
+                    deleted += 1
+                    logging.debug(f"Deleted file: {path}")
+                except PermissionError as e:
+                    logging.error(f"Permission error while deleting file {path}: {e}")
+                except Exception as e:
+                    logging.error(f"Failed to delete file {path}: {e}")
+        finally:
+            os.close(dir_fd)
+    return deleted
+
+def copy_file_data(src_fd, dst_fd, size):
+    # copy inside the kernel where possible: copy_file_range, then sendfile, then a plain read/write loop;
+    # a method that stops short (returns 0 or fails) hands the rest over to the next one
+    offset = 0
+    try:
+        while offset < size:
+            copied = os.copy_file_range(src_fd, dst_fd, size - offset)
+            if copied == 0:
+                break
+            offset += copied
+    except (AttributeError, OSError):
+        pass
+    if offset < size:
+        try:
+            while offset < size:
+                copied = os.sendfile(dst_fd, src_fd, offset, size - offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError:
+            pass
+    if offset < size:
+        os.lseek(src_fd, offset, os.SEEK_SET)
+        os.lseek(dst_fd, offset, os.SEEK_SET)
+        with open(src_fd, 'rb', closefd=False) as src, open(dst_fd, 'wb', closefd=False) as dst:
+            shutil.copyfileobj(src, dst)
+        offset = os.fstat(dst_fd).st_size
+    if offset < size:
+        raise OSError(f"Copied only {offset} of {size} bytes")
+
 def copy_file_with_directory_structure(source_base_path, source_file_path, dest_base_path):
     relative_path = os.path.relpath(source_file_path, source_base_path)
-    destination_path = os.path.join(dest_base_path, os.path.dirname(relative_path))
-    logging.info(f"Copy {source_file_path} to {destination_path}")
-    os.makedirs(destination_path, exist_ok=True)
-    shutil.copy2(source_file_path, destination_path)
+    destination_file_path = os.path.join(dest_base_path, relative_path)
+    logging.debug(f"Copy {source_file_path} to {destination_file_path}")
+    src_fd = os.open(source_file_path, os.O_RDONLY)
+    try:
+        st = os.fstat(src_fd)
+        dst_fd = os.open(destination_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            # the copied files are rarely read again, so keep them from pushing the working set out of the page cache
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            copy_file_data(src_fd, dst_fd, st.st_size)
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                os.posix_fadvise(dst_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    os.utime(destination_file_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+def get_cached_loop_device():
+    # /run is cleared on reboot; sysfs confirms the device still backs USB_IMG without running losetup
+    try:
+        with open(LOOP_DEVICE_CACHE) as cache_file:
+            name = cache_file.read().strip()
+        with open(f"/sys/block/{os.path.basename(name)}/loop/backing_file") as backing_file:
+            if backing_file.read().strip() == USB_IMG:
+                return name
+    except OSError:
+        pass
+    return None
 
 def get_loop_device():
-    jsonLoop = json.loads(subprocess.run(['losetup', '-l', '-J'], capture_output=True, text=True).stdout)
-    for ld in jsonLoop['loopdevices']:
-        if ld['back-file'] == USB_IMG: 
-            return ld['name']
-    result = subprocess.run(['sudo', 'losetup', '-fP', '--show', USB_IMG], capture_output=True, text=True)
+    name = get_cached_loop_device()
+    if name:
+        return name
+    name = subprocess.run(['losetup', '-j', USB_IMG, '-O', 'NAME', '-n'], capture_output=True, text=True).stdout.partition('\n')[0].strip()
+    if not name:
+        result = subprocess.run(['sudo', 'losetup', '-fP', '--show', USB_IMG], capture_output=True, text=True)
+        
+        # Version 2 Change: Add error handling for subprocess call.
+        if result.returncode != 0:
+            logging.error(f"Failed to set up loop device: {result.stderr}")
+            raise Exception(f"Failed to set up loop device: {result.stderr}")
+        name = result.stdout.strip()
     
-    # Version 2 Change: Add error handling for subprocess call.
+    # /run is only writable by root, so the cache is written through sudo like the mount and losetup calls
+    result = subprocess.run(['sudo', 'tee', LOOP_DEVICE_CACHE], input=name, capture_output=True, text=True)
     if result.returncode != 0:
-        logging.error(f"Failed to set up loop device: {result.stderr}")
-        raise Exception(f"Failed to set up loop device: {result.stderr}")
-    
-    return result.stdout.strip()
+        logging.warning(f"Could not cache loop device in {LOOP_DEVICE_CACHE}: {result.stderr}")
+    return name
 
-def mount(device, mount_dir):
-    result = subprocess.call(['sudo', 'mount', '-t', 'exfat', device, mount_dir]) 
+def mount(device, mount_dir, read_only=False):
+    options = ['-o', 'ro'] if read_only else []
+    result = subprocess.call(['sudo', 'mount', '-t', 'exfat'] + options + [device, mount_dir]) 
     # Version 2 Change: Added error handling for mount command.
     if result != 0:
         logging.error(f"Failed to mount {device} at {mount_dir}")
         raise Exception(f"Failed to mount {device} at {mount_dir}")
-    time.sleep(0.5)
 
 def umount(mount_dir):
     result = subprocess.call(['sudo', 'umount', '-f', mount_dir])  # -f force 
@@ -112,58 +222,99 @@ def umount(mount_dir):
     if result != 0:
         logging.error(f"Failed to unmount {mount_dir}")
         raise Exception(f"Failed to unmount {mount_dir}")
-    time.sleep(0.5)
-
-def check_and_delete_on_usb(cycle_counter, device, config):
-    check_count = config['DeleteOnUSBCycleTime'] / config['CopyCheckCycleTime']
-    cycle_counter[0] += 1
-    if cycle_counter[0] > check_count:
-        logging.info(f"Perform usb deletion check. Counter: {cycle_counter[0]}")
-        mount(device, SOURCE_DIR)
-        file_entries = get_all_file_entries_delete_empty_dirs(SOURCE_DIR) 
-        max_file_diff = len(file_entries) - config['KeepMaxFilesOnUSB']
-        logging.info(f"Max_file_diff: {max_file_diff}")
-        if max_file_diff > 0:
-            file_entries.sort(key=lambda f: f.stat().st_mtime)
-            for i in range(max_file_diff):
-                try:
-                    os.remove(file_entries[i].path)
-                    logging.info(f"Deleted file: {file_entries[i].path}")
-                except PermissionError as e:
-                    logging.error(f"Permission error while deleting file {file_entries[i].path}: {e}")
-                except Exception as e:
-                    logging.error(f"Failed to delete file {file_entries[i].path}: {e}")
+
+def remount(mount_dir, read_only):
+    result = subprocess.call(['sudo', 'mount', '-o', 'remount,ro' if read_only else 'remount,rw', mount_dir])
+    if result != 0:
+        logging.error(f"Failed to remount {mount_dir}")
+        raise Exception(f"Failed to remount {mount_dir}")
+
+def open_usb(device, config, read_only=False):
+    # a fresh mount per run is what makes the host's writes visible and keeps our cached FAT from overwriting them;
+    # with KeepUSBMounted the long-lived mount is read-only and only switched to read-write for a deletion run
+    if not config.KeepUSBMounted:
+        mount(device, SOURCE_DIR, read_only)
+    elif not read_only:
+        remount(SOURCE_DIR, read_only=False)
+
+def close_usb(config, inotify, read_only=False):
+    # returns True when queued image events were dropped; they may include host writes, so the caller must
+    # schedule a copy run itself. A read-only run does not write to the image and leaves the events queued.
+    if read_only:
+        if not config.KeepUSBMounted:
+            umount(SOURCE_DIR)
+        return False
+    if config.KeepUSBMounted:
+        remount(SOURCE_DIR, read_only=True)  # also flushes our changes to the image
+    else:
         umount(SOURCE_DIR)
-        cycle_counter[0] = 0    
+    inotify.read(timeout=0)  # drop the image writes caused by our own changes, mount and unmount
+    return True
 
-def copy_new_files(last_modify_time, device):
+def check_and_delete_on_usb(device, config, inotify):
+    logging.info("Perform usb deletion check.")
+    open_usb(device, config)
+    file_entries = get_all_file_entries_delete_empty_dirs(SOURCE_DIR) 
+    max_file_diff = len(file_entries) - config.KeepMaxFilesOnUSB
+    logging.info(f"Max_file_diff: {max_file_diff}")
+    if max_file_diff > 0:
+        # only the oldest max_file_diff entries are needed; a partial sort is cheaper while that is a small share
+        if max_file_diff > len(file_entries) / 2:
+            file_entries.sort(key=lambda f: f[0])
+            victims = file_entries[:max_file_diff]
+        else:
+            victims = heapq.nsmallest(max_file_diff, file_entries, key=lambda f: f[0])
+        deleted = delete_files(path for _, path in victims)
+        logging.info(f"Deleted {deleted}/{max_file_diff} files")
+    return close_usb(config, inotify)
+
+def copy_new_files(last_modify_time, device, config, inotify):
     current_modify_time = os.stat(USB_IMG).st_mtime
-    if current_modify_time > last_modify_time[0]:
-        mount(device, SOURCE_DIR)
-        destination_dir = os.path.join(DESTINATION_BASE_DIR, str(int(current_modify_time)))
-        new_files = get_files_since_point_in_time(SOURCE_DIR, last_modify_time[0], newest_dir_count=2)
-        
-        # Version 2 Change: Ensure 'COPYING_ACTIVE_FILE' is properly managed.
-        if os.path.isfile(COPYING_ACTIVE_FILE):
-            logging.warning(f"{COPYING_ACTIVE_FILE} already exists. Removing it to continue.")
-            os.remove(COPYING_ACTIVE_FILE)
-        Path(COPYING_ACTIVE_FILE).touch()
-        
-        for file in new_files:
-            copy_file_with_directory_structure(SOURCE_DIR, file, destination_dir)
-        
-        if os.path.isfile(COPYING_ACTIVE_FILE):
-            os.remove(COPYING_ACTIVE_FILE)
-        umount(SOURCE_DIR)
-        last_modify_time[0] = os.stat(USB_IMG).st_mtime
+    open_usb(device, config, read_only=True)
+    destination_dir = os.path.join(DESTINATION_BASE_DIR, str(int(current_modify_time)))
+    new_files = get_files_since_point_in_time(SOURCE_DIR, last_modify_time[0], newest_dir_count=2)
+    
+    # a single atomic rename flags the copy as active for the upload service
+    try:
+        os.rename(COPYING_IDLE_FILE, COPYING_ACTIVE_FILE)
+    except FileNotFoundError:
+        logging.warning(f"{COPYING_IDLE_FILE} is missing. Creating {COPYING_ACTIVE_FILE} directly.")
+        open(COPYING_ACTIVE_FILE, 'w').close()
+    
+    # create each target directory once, up front, so the copy workers never race on makedirs;
+    # sorted so parents exist before their children and each makedirs only has the last level to create
+    directories = {os.path.join(destination_dir, os.path.dirname(os.path.relpath(file, SOURCE_DIR))) for file in new_files}
+    for directory in sorted(directories):
+        os.makedirs(directory, exist_ok=True)
+    
+    # overlap reading from the usb image with writing to the sd card
+    copied = 0
+    failed = 0
+    with ThreadPoolExecutor(max_workers=config.CopyParallelism) as pool:
+        futures = {pool.submit(copy_file_with_directory_structure, SOURCE_DIR, file, destination_dir): file for file in new_files}
+        for future in as_completed(futures):
+            if future.exception():
+                failed += 1
+                logging.warning(f"Failed to copy {futures[future]}: {future.exception()}")
+            else:
+                copied += 1
+    logging.info(f"Copied {copied} files, {failed} failed, to {destination_dir}")
+    
+    try:
+        os.rename(COPYING_ACTIVE_FILE, COPYING_IDLE_FILE)
+    except FileNotFoundError:
+        open(COPYING_IDLE_FILE, 'w').close()
+    close_usb(config, inotify, read_only=True)
+    # host writes during this run leave their events queued and wake the next run, which picks up
+    # every file newer than this
+    last_modify_time[0] = current_modify_time
 
 # ----------------
 # MAIN
 # ----------------
 setup_logging(os.path.join(BASE_PATH, 'logs/copyLogging.log')) 
 
-config = []
-cycle_counter = [0]
+config = None
 last_modify_time = [os.stat(USB_IMG).st_mtime]
 
 try:
@@ -172,7 +323,7 @@ try:
     # Version 2 Change: Added error handling for config file loading.
     try:
         with open(os.path.join(BASE_PATH,'config.json')) as config_file:
-            config = json.load(config_file)
+            config = Config(**{k: v for k, v in json.load(config_file).items() if k in Config._fields})
         logging.info(f"Configuration loaded.")
     except json.JSONDecodeError as e:
         logging.error(f"Failed to decode config file: {e}")
@@ -180,16 +331,50 @@ try:
     except FileNotFoundError as e:
         logging.error(f"Config file not found: {e}")
         raise
+    except TypeError as e:
+        logging.error(f"Config file is missing a required setting: {e}")
+        raise
+
+    # Version 2 Change: Ensure 'COPYING_ACTIVE_FILE' is properly managed.
+    os.makedirs(DESTINATION_BASE_DIR, exist_ok=True)
+    try:
+        os.replace(COPYING_ACTIVE_FILE, COPYING_IDLE_FILE)
+        logging.warning(f"{COPYING_ACTIVE_FILE} already existed. Reset it to continue.")
+    except FileNotFoundError:
+        open(COPYING_IDLE_FILE, 'w').close()
 
     # get loop device for partition access
     loop_device = get_loop_device() + 'p1'  # primary partition 1 
     logging.info(f"Loop Device: {loop_device}")
 
+    if config.KeepUSBMounted:
+        mount(loop_device, SOURCE_DIR, read_only=True)
+        atexit.register(umount, SOURCE_DIR)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # let atexit unmount on service stop
+
+    # block in the kernel until the usb host writes to the image instead of polling its mtime
+    inotify = INotify()
+    inotify.add_watch(USB_IMG, flags.CLOSE_WRITE | flags.MODIFY)
+    delete_cycle_time = config.DeleteOnUSBCycleTime
+    copy_cycle_time = config.CopyCheckCycleTime
+    next_delete_check = time.monotonic() + delete_cycle_time
+    next_copy_run = time.monotonic()
+    copy_pending = False
+
     # main loop
     while True:
-        check_and_delete_on_usb(cycle_counter, loop_device, config)
-        copy_new_files(last_modify_time, loop_device)
-        time.sleep(config['CopyCheckCycleTime'])
+        timeout = 0 if copy_pending else max(0, next_delete_check - time.monotonic())
+        if inotify.read(timeout=int(timeout * 1000)) or copy_pending:
+            copy_pending = False
+            # wait until the host has stopped writing, and keep at least CopyCheckCycleTime between copy runs
+            while inotify.read(timeout=int(max(EVENT_DEBOUNCE_TIME, next_copy_run - time.monotonic()) * 1000)):
+                pass
+            copy_new_files(last_modify_time, loop_device, config, inotify)
+            next_copy_run = time.monotonic() + copy_cycle_time
+        if time.monotonic() >= next_delete_check:
+            # the deletion run drops queued events, host writes included, so follow it with a copy run
+            copy_pending = check_and_delete_on_usb(loop_device, config, inotify)
+            next_delete_check = time.monotonic() + delete_cycle_time
 
 except Exception as ex:
     logging.exception(ex)
@@ -73,7 +73,8 @@ echo "-----------------------------------------------------------------"
 echo "Prepare Python copy and upload services"
 echo "-----------------------------------------------------------------"
 
-sudo apt-get -y install expect
+# paramiko keeps one SFTP session open for the upload service's SCP sync
+sudo apt-get -y install python3-paramiko
 
 # Version 2 Change:
 # Reason: In newer Raspberry Pi OS versions, 'python3-dropbox' may be unavailable via apt.
@@ -83,6 +84,33 @@ if ! dpkg -s python3-dropbox >/dev/null 2>&1; then
   sudo pip3 install dropbox
 fi
 
+# inotify_simple lets the copy service wait for writes to /piusb.bin instead of polling it.
+if ! dpkg -s python3-inotify-simple >/dev/null 2>&1; then
+  sudo apt-get -y install python3-inotify-simple || sudo pip3 install inotify_simple
+fi
+
+# The copy and upload services run under PyPy (see the script shebangs); its JIT speeds up their pure-Python loops.
+# PyPy has its own site-packages, so the dropbox, inotify_simple and paramiko modules are installed for it as well.
+pypy_ready=no
+if sudo apt-get -y install pypy3 && \
+   { pypy3 -m pip --version >/dev/null 2>&1 || sudo pypy3 -m ensurepip; } && \
+   sudo pypy3 -m pip install dropbox inotify_simple paramiko && \
+   pypy3 -c "import dropbox, inotify_simple, paramiko"; then
+  pypy_ready=yes
+fi
+
+# If any PyPy step failed, switch the services back to CPython, which has the modules installed above.
+if [ "$pypy_ready" = no ]; then
+  echo "PyPy setup failed, running the services under python3."
+  for script in copy_new_usb_files_v2.py upload_new_files_v2.py; do
+    if [ -f "/home/pi/$script" ]; then
+      sed -i '1s|^#!/usr/bin/env pypy3|#!/usr/bin/env python3|' "/home/pi/$script"
+    else
+      echo "$script not found!"
+    fi
+  done
+fi
+
 echo "-----------------------------------------------------------------"
 echo "Add system services"
 echo "-----------------------------------------------------------------"
@@ -1,10 +1,14 @@
-#!/usr/bin/env python
+#!/usr/bin/env pypy3
 
-import os, subprocess, shutil, time, json
+import os, shutil, time, json, posixpath
 import logging, logging.handlers
 import dropbox
-from dropbox.files import WriteMode
+import paramiko
+from dropbox.files import WriteMode, UploadSessionCursor, CommitInfo
 from inspect import getsourcefile
+from typing import NamedTuple, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from inotify_simple import INotify, flags
 
 #######################################################################
 # Script: Dropbox and SCP File Transfer Service
@@ -24,6 +28,21 @@ from inspect import getsourcefile
 BASE_PATH = os.path.dirname(os.path.abspath(getsourcefile(lambda:0)))
 SOURCE_BASE_DIR = os.path.join(BASE_PATH, 'transfer')
 COPYING_ACTIVE_FILE = os.path.join(SOURCE_BASE_DIR, 'copyingActive')
+DROPBOX_CHUNK_SIZE = 4 * 1024 * 1024
+DROPBOX_SESSION_THRESHOLD = 8 * 1024 * 1024  # larger files are streamed in chunks instead of read whole
+
+class Config(NamedTuple):
+    # settings read from config.json; unknown keys are ignored
+    ActivateDropboxSync: bool = False
+    ActivateScpSync: bool = False
+    DropBoxRefreshToken: str = ''
+    DropboxAppKey: str = ''
+    DropboxAppSecret: str = ''
+    DropBoxPath: str = ''
+    DropboxParallelism: int = 4
+    ScpPath: str = ''
+    ScpPassword: Optional[str] = None
+    ScpKeyFile: Optional[str] = None
 
 def setup_logging(log_file_full_path):
     base_path = os.path.split(log_file_full_path)[0]
@@ -42,26 +61,61 @@ def setup_logging(log_file_full_path):
     console_handler.setFormatter(log_formatter)
     root_logger.addHandler(console_handler)
 
-def wait_until_no_copying_active(copy_active_file):
-    max_time = 0
+def wait_until_no_copying_active(copy_active_file, inotify):
+    # inotify watches SOURCE_BASE_DIR, so the flag being renamed away or deleted wakes us immediately
+    deadline = time.monotonic() + 30
     while os.path.isfile(copy_active_file):
-        time.sleep(1)
-        max_time += 1
-        if max_time > 30:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
             logging.warning("Timed out waiting for copying to finish.")
             break
+        inotify.read(timeout=int(remaining * 1000))
+
+def parse_scp_path(scp_path):
+    # ScpPath keeps the scp target format: [user@]host:remote_dir
+    user_host, remote_dir = scp_path.split(':', 1)
+    user, _, host = user_host.rpartition('@')
+    return user or None, host, remote_dir
 
-def transfer_via_scp(source_dir, config):
-    source_dir_content = os.path.join(source_dir, '*')
+def connect_sftp(config, ssh=None):
+    # (re)opens the shared session and returns (ssh, sftp); both are None if the host cannot be reached
+    if ssh is not None:
+        ssh.close()  # also stops the transport thread of the dropped session
+    ssh = paramiko.SSHClient()
     try:
-        result = subprocess.run(['expect', '-f', 'scp-copy.exp', source_dir_content, config['ScpPath']], capture_output=True, text=True)
-        # Version 2 Change: Added error handling and improved logging.
-        if result.returncode != 0:
-            logging.error(f"SCP transfer failed: {result.stderr}")
-        else:
-            logging.info(f"SCP transfer successful: {result.stdout}")
+        user, host, _ = parse_scp_path(config.ScpPath)
+        ssh.load_system_host_keys()
+        ssh.connect(host, username=user, password=config.ScpPassword, key_filename=config.ScpKeyFile)
+        sftp = ssh.open_sftp()
     except Exception as e:
-        logging.error(f"Failed to execute SCP transfer: {e}")
+        logging.error(f"Failed to open SFTP session for {config.ScpPath}: {e}")
+        ssh.close()
+        return None, None
+    logging.info(f"SFTP session opened to {host}")
+    return ssh, sftp
+
+def make_remote_dirs(sftp, remote_dir, created_dirs):
+    if remote_dir in ('', '/') or remote_dir in created_dirs:
+        return
+    make_remote_dirs(sftp, posixpath.dirname(remote_dir.rstrip('/')), created_dirs)
+    try:
+        sftp.stat(remote_dir)
+    except FileNotFoundError:
+        sftp.mkdir(remote_dir)
+    created_dirs.add(remote_dir)
+
+def transfer_via_scp(sftp, source_dir, config):
+    _, _, remote_base_dir = parse_scp_path(config.ScpPath)
+    created_dirs = set()
+    for local_path in get_all_files(source_dir):
+        relative_path = os.path.relpath(local_path, source_dir)
+        remote_path = posixpath.join(remote_base_dir, *relative_path.split(os.sep))
+        try:
+            make_remote_dirs(sftp, posixpath.dirname(remote_path), created_dirs)
+            sftp.put(local_path, remote_path)
+            logging.info(f"SFTP transfer successful: {remote_path}")
+        except Exception as e:
+            logging.error(f"Failed to transfer {local_path} via SFTP: {e}")
 
 def get_all_files(folder):
     all_files = []
@@ -72,23 +126,42 @@ def get_all_files(folder):
             all_files.extend(get_all_files(item.path))
     return all_files
 
+def upload_file_to_dropbox(dbx, f, file_size, destination_path):
+    if file_size <= DROPBOX_SESSION_THRESHOLD:
+        return dbx.files_upload(f.read(), destination_path, mode=WriteMode('overwrite'))
+    session = dbx.files_upload_session_start(f.read(DROPBOX_CHUNK_SIZE))
+    cursor = UploadSessionCursor(session_id=session.session_id, offset=f.tell())
+    commit = CommitInfo(path=destination_path, mode=WriteMode('overwrite'))
+    while file_size - f.tell() > DROPBOX_CHUNK_SIZE:
+        dbx.files_upload_session_append_v2(f.read(DROPBOX_CHUNK_SIZE), cursor)
+        cursor.offset = f.tell()
+    return dbx.files_upload_session_finish(f.read(DROPBOX_CHUNK_SIZE), cursor, commit)
+
+def transfer_file_to_dropbox(dbx, file, source_dir, config):
+    # errors are raised to transfer_to_dropbox, which logs them per file
+    with open(file, mode='rb') as f:
+        destination_path = os.path.join(config.DropBoxPath) + os.path.relpath(file, source_dir)
+        logging.info(f"STARTING Dropbox upload to: {destination_path}")
+        file_metadata = upload_file_to_dropbox(dbx, f, os.path.getsize(file), destination_path)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)  # uploaded files are not read again
+        logging.info(f"FINISHED Dropbox upload: {file_metadata.path_display}")
+
 def transfer_to_dropbox(source_dir, config):
-    token = config['DropBoxRefreshToken']
-    key = config['DropboxAppKey']
-    secret = config['DropboxAppSecret']
+    token = config.DropBoxRefreshToken
+    key = config.DropboxAppKey
+    secret = config.DropboxAppSecret
     with dropbox.Dropbox(oauth2_refresh_token=token, app_key=key, app_secret=secret) as dbx:
         all_files = get_all_files(source_dir)
-        for file in all_files:
-            try:
-                with open(file, mode='rb') as f:
-                    destination_path = os.path.join(config['DropBoxPath']) + os.path.relpath(file, source_dir)
-                    logging.info(f"STARTING Dropbox upload to: {destination_path}")
-                    file_metadata = dbx.files_upload(f.read(), destination_path, mode=WriteMode('overwrite'))
-                    logging.info(f"FINISHED Dropbox upload: {file_metadata.path_display}")
-            except dropbox.exceptions.ApiError as e:
-                logging.error(f"Dropbox API error during file upload: {e}")
-            except Exception as e:
-                logging.error(f"Failed to upload file {file} to Dropbox: {e}")
+        # uploads are network bound, so several can share the (thread-safe) client at once
+        with ThreadPoolExecutor(max_workers=config.DropboxParallelism) as pool:
+            futures = {pool.submit(transfer_file_to_dropbox, dbx, file, source_dir, config): file for file in all_files}
+            for future in as_completed(futures):
+                e = future.exception()
+                if isinstance(e, dropbox.exceptions.ApiError):
+                    logging.error(f"Dropbox API error during upload of {futures[future]}: {e}")
+                elif e:
+                    logging.error(f"Failed to upload file {futures[future]} to Dropbox: {e}")
 
 # ----------------
 # MAIN
@@ -102,7 +175,7 @@ try:
     # Version 2 Change: Improved error handling for config file loading.
     try:
         with open(os.path.join(BASE_PATH, 'config.json')) as config_file:
-            config = json.load(config_file)
+            config = Config(**{k: v for k, v in json.load(config_file).items() if k in Config._fields})
         logging.info(f"Configuration loaded.")
     except json.JSONDecodeError as e:
         logging.error(f"Failed to decode config file: {e}")
@@ -111,15 +184,35 @@ try:
         logging.error(f"Config file not found: {e}")
         raise
 
+    inotify = INotify()
+    inotify.add_watch(SOURCE_BASE_DIR, flags.MOVED_FROM | flags.DELETE)
+
+    dropbox_sync = config.ActivateDropboxSync
+    scp_sync = config.ActivateScpSync
+    last_base_mtime = 0
+    # one ssh session is kept open for all transfers instead of a handshake per folder
+    ssh, sftp = connect_sftp(config) if scp_sync else (None, None)
+
     while True:
+        # new folders change the mtime of the base dir, so an idle cycle costs one stat instead of a scandir
+        base_mtime = os.stat(SOURCE_BASE_DIR).st_mtime
+        if base_mtime == last_base_mtime:
+            time.sleep(4.5)
+            continue
+        last_base_mtime = base_mtime
         folders_to_transfer = [d for d in os.scandir(SOURCE_BASE_DIR) if d.is_dir()]
         if folders_to_transfer:
-            wait_until_no_copying_active(COPYING_ACTIVE_FILE)
+            wait_until_no_copying_active(COPYING_ACTIVE_FILE, inotify)
             for folder in folders_to_transfer:
-                if config.get('ActivateDropboxSync', False):
+                if dropbox_sync:
                     transfer_to_dropbox(folder, config)
-                if config.get('ActivateScpSync', False):
-                    transfer_via_scp(folder, config)
+                if scp_sync:
+                    if sftp is None or sftp.sock.closed:
+                        ssh, sftp = connect_sftp(config, ssh)
+                    if sftp is not None:
+                        transfer_via_scp(sftp, folder, config)
+                    else:
+                        logging.error(f"Skipping SFTP transfer of {folder.path}, no session to {config.ScpPath}")
                 shutil.rmtree(folder)  # delete the folder after transfer
         time.sleep(4.5)
 